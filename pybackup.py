@@ -1,15 +1,24 @@
 #!/usr/bin/env python3
 
 import argparse
-import calendar
+import errno
+import fcntl
+import functools
+import json
 import os
 import pwd
+import re
 import shutil
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
 import yaml
-from collections import OrderedDict
-from datetime import datetime, timedelta
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
 from pathlib import Path
 
 CONFIG_LOCATION: Path = Path('/etc/pybackup')
@@ -18,41 +27,207 @@ SCRIPT_LOCATION: Path = Path('/bin/pybackup.py')
 BACKUP_LOCATION: Path = Path('/opt/backups')
 SERVICE_PATH: Path = Path('/etc/systemd/system/pybackup.service')
 LASTRUN_FILE: Path = BACKUP_LOCATION / 'lastrun.txt'
-
-START_TIME: datetime = datetime.now().replace(second=0, microsecond=0)
-START_TIME_STR: str = START_TIME.strftime('%Y-%m-%d_%H:%M')
-
-try:
-    with open(LASTRUN_FILE, 'r') as g:
-        LASTRUN: datetime = datetime.fromtimestamp(int(g.read()))
-except FileNotFoundError:
-    LASTRUN: datetime = datetime.fromtimestamp(0)
+LASTRUN_LOCK: Path = BACKUP_LOCATION / 'lastrun.lock'
+RSYNC: str | None = shutil.which('rsync')
+# rsync exit codes after which the snapshot is still usable: 24 is source files vanishing mid-transfer, routine on a live tree,
+# and 23 is some files or directories not being transferred, like unreadable ones, which are reported and left out
+RSYNC_PARTIAL_CODES: dict[int, str] = {23: 'some files could not be transferred', 24: 'some source files vanished during the transfer'}
+
+SNAPSHOT_FORMAT: str = '%Y-%m-%d_%H:%M'
+
+# Backup methods Destination.backup can carry out so far
+BACKUP_METHODS: tuple[str, ...] = ('cp', 'rsync')
+
+# rsync reads a colon before the first "/", as in "host:/path" or "rsync://host/path", as a remote location
+REMOTE_PATH_RE: re.Pattern = re.compile(r'[^/]*:')
+
+
+class LastRuns:
+    # When each destination last completed a backup, kept in LASTRUN_FILE as
+    # {"default": POSIX seconds, "times": {source path: {destination path: POSIX seconds}}}
+    # "default" is the time for destinations without one of their own. Files from before times were kept per destination hold only that time
+    # Recorded per destination as soon as it succeeds, so a failing destination doesn't hold the others back,
+    # and destinations a run doesn't cover, like the other sources during a --target run, keep their own times
+    def __init__(self, times: dict[str, dict[str, int]], default: int = 0):
+        self._times = times
+        self._default = default
+        # Destinations finish concurrently
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def _is_time(value) -> bool:
+        # True for an int datetime.fromtimestamp can take; bool is an int subclass but never a time
+        return type(value) is int and 0 <= value < 2**35
+
+
+    @classmethod
+    def _read(cls) -> tuple[dict[str, dict[str, int]], int]:
+        # Returns the times and the default in LASTRUN_FILE, leaving out anything malformed
+        # A missing or unreadable file counts as never having run, rather than stopping every backup
+        try:
+            fd = os.open(LASTRUN_FILE, os.O_RDONLY | os.O_CLOEXEC)
+            with os.fdopen(fd, 'r') as g:
+                contents = json.load(g)
+        except (FileNotFoundError, ValueError):
+            return {}, 0
+
+        if cls._is_time(contents):
+            return {}, contents
+        if not isinstance(contents, dict):
+            return {}, 0
+
+        default = contents.get('default', 0)
+        stored_times = contents.get('times')
+        times = {}
+        if isinstance(stored_times, dict):
+            for source, destinations in stored_times.items():
+                if isinstance(destinations, dict):
+                    times[source] = {destination: t for destination, t in destinations.items() if cls._is_time(t)}
+
+        return times, default if cls._is_time(default) else 0
+
+
+    @classmethod
+    def load(cls) -> 'LastRuns':
+        return cls(*cls._read())
+
+
+    def get(self, source: str, destination: str) -> datetime:
+        # Returns the time of the last completed backup of source to destination
+        with self._lock:
+            return datetime.fromtimestamp(self._times.get(source, {}).get(destination, self._default))
+
+
+    def record(self, source: str, destination: str, run_time: datetime) -> None:
+        # Records run_time as the last completed backup of source to destination, and saves it straight away
+        # Separate processes, like a manual run overlapping a scheduled one, can record at the same time, so the file is locked,
+        # re-read and merged into rather than overwritten with this process's copy. Times only ever move forwards
+        # Written to a uniquely named temporary file and renamed over the old one, so readers see either the old or the new times, never a partial write
+        with self._lock, open(LASTRUN_LOCK, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            times, default = self._read()
+            recorded = times.setdefault(source, {})
+            recorded[destination] = max(recorded.get(destination, default), int(run_time.timestamp()))
+            self._times, self._default = times, default
+
+            fd, tmp_file = tempfile.mkstemp(dir=LASTRUN_FILE.parent, prefix='.lastrun.')
+            try:
+                try:
+                    os.write(fd, json.dumps({'default': default, 'times': times}).encode())
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                os.replace(tmp_file, LASTRUN_FILE)
+            except BaseException:
+                os.unlink(tmp_file)
+                raise
+
+
+@dataclass(slots=True, frozen=True)
+class BackupContext:
+    # The state one backup cycle works from. Built once per cycle and passed down, rather than fixed at import,
+    # so a long-running process gets fresh times every cycle
+    now: datetime
+    lastruns: LastRuns
+
+    @classmethod
+    def start(cls) -> 'BackupContext':
+        # Starts a cycle now, truncated to the minute like cron, from the last recorded runs
+        return cls(datetime.now().replace(second=0, microsecond=0), LastRuns.load())
+
+    @property
+    def snapshot_name(self) -> str:
+        # Snapshot directories are named after the start of the cycle that made them, which sorts chronologically
+        return self.now.strftime(SNAPSHOT_FORMAT)
+
+
+# libyaml's loader is much faster than the pure-Python one, but PyYAML isn't always built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# (path, mtime in nanoseconds, size, device, inode, mode, uid, gid) for each directory, file or symlink found by Source._walk
+WalkEntry = tuple[str, int, int, int, int, int, int, int]
+
+
+def _stat_entry(entry: os.DirEntry) -> tuple[int, int, int, int, int, int, int]:
+    # Takes a directory entry, returns its mtime in nanoseconds, size, device, inode, mode, uid and gid without following symlinks
+    # A plain lstat through DirEntry.stat; statx through ctypes is still one syscall per entry, and the marshalling makes it twice as slow
+    st = entry.stat(follow_symlinks=False)
+    return st.st_mtime_ns, st.st_size, st.st_dev, st.st_ino, st.st_mode, st.st_uid, st.st_gid
+
+
+def _copy_file(src: str, dst: str) -> None:
+    # Copies the contents of src to dst without the data passing through Python
+    # copy_file_range lets btrfs and XFS share the extents instead of writing them again
+    # Falls back to sendfile where copy_file_range isn't supported, such as across filesystems on kernels older than 5.3
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            try:
+                while os.copy_file_range(src_fd, dst_fd, 1 << 30):
+                    pass
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP) or os.lseek(dst_fd, 0, os.SEEK_CUR):
+                    raise
+                while os.sendfile(dst_fd, src_fd, None, 1 << 30):
+                    pass
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _remove_snapshot(path: str) -> None:
+    # Removes a snapshot left half-written by a failed backup, so later cycles don't take it for a complete one
+    # Directories may already have their source's read-only modes, so they're all made writable first
+    # Symlinks to directories are left alone, as chmod would follow them out of the snapshot
+    os.chmod(path, 0o700)
+    for root, dirs, _ in os.walk(path):
+        for name in dirs:
+            dir_path = os.path.join(root, name)
+            if not os.path.islink(dir_path):
+                os.chmod(dir_path, 0o700)
+    shutil.rmtree(path)
 
 
 class Interval:
     # Takes a cron-style string "*/5 1,3,7 30 10-12 *"
     # Intended use is to verify validity when instantiated, then check if the next backup should be started using "<object>.should_backup()"
-    # Relies on global START_TIME at construction; needed to correctly set the max days of the month
+
+    # Every destination holds one, so skip the per-instance __dict__
+    __slots__ = ('_interval_dict', '_minutes_of_day')
 
     FIELD_NAMES: list[str] = ['minute', 'hour', 'day_of_month', 'month', 'day_of_week']
 
-    def __init__(self, cron_string: str):
-        self._interval_dict: OrderedDict[str, list[int]] = OrderedDict.fromkeys(self.FIELD_NAMES)
+    # Valid values of each field. As in cron, day_of_month allows up to 31 whatever the month; days a month lacks never match
+    _VALID_RANGES: dict[str, range] = {
+        'minute': range(0, 60),
+        'hour': range(0, 24),
+        'day_of_month': range(1, 32),
+        'month': range(1, 13),
+        'day_of_week': range(0, 8) # 0 and 7 are both Sunday
+    }
 
-        self._valid_ranges: dict[str, range] = {
-            'minute': range(0, 60),
-            'hour': range(0, 24),
-            'day_of_month': range(1, calendar.monthrange(START_TIME.year, START_TIME.month)[1]+1),
-            'month': range(1, 13),
-            'day_of_week': range(0, 8) # 0 and 7 are both Sunday
-        }
+    # One comma-separated value: "*", "A" or "A-B", optionally followed by "/N"
+    _TOKEN_RE: re.Pattern = re.compile(r'(\*|([0-9]+)(?:-([0-9]+))?)(?:/([0-9]+))?')
+
+    def __init__(self, cron_string: str):
+        self._interval_dict: dict[str, int] = dict.fromkeys(self.FIELD_NAMES)
 
         self._parse_cron_string(cron_string)
 
+        # Bit h*60 + m is set for every scheduled time of day, so should_backup can test a whole span of minutes with one AND
+        self._minutes_of_day: int = 0
+        for hour in range(24):
+            if (self._interval_dict['hour'] >> hour) & 1:
+                self._minutes_of_day |= self._interval_dict['minute'] << (hour * 60)
+
     def _parse_cron_string(self, cron_string: str):
         # Takes a cron-style string
         # Raises ValueErrors if the number of fields is incorrect
-        # Returns lists of valid ints for each interval
+        # Stores a bitmask of valid values for each interval
 
         fields = cron_string.strip().split()
         if len(fields) != 5:
@@ -61,85 +236,157 @@ class Interval:
         for name, value in zip(self.FIELD_NAMES, fields):
             self._interval_dict[name] = self._parse_interval(name, value)
 
+        # 7 is another way of writing Sunday, so fold it into 0
+        if (self._interval_dict['day_of_week'] >> 7) & 1:
+            self._interval_dict['day_of_week'] |= 1
 
-    def _parse_interval(self, interval_type: str, interval_string: str) -> list[int]:
-        # Takes a cron-style string for a given interval: "*/5", "1,3,7", or "2-6"
-        # Returns a list of valid values
-        # Raises ValueErrors if given values are out of range
 
-        valid_min = self._valid_ranges[interval_type][0]
-        valid_max = self._valid_ranges[interval_type][-1]
-        valid_range = self._valid_ranges[interval_type]
+    def _parse_interval(self, interval_type: str, interval_string: str) -> int:
+        # Takes a cron-style string for a given interval: "*/5", "1,3,7", "2-6" or "1-10/3,20"
+        # Returns a bitmask of valid values; bit k is set if k is valid
+        # Raises ValueErrors if given values are malformed or out of range
 
-        # "/" used to set step value
-        if '/' in interval_string:
-            if interval_string.count('/') > 1:
-                raise ValueError('Can only have one "/" in interval')
-            interval_string, step = interval_string.split('/')
-            step = int(step)
-        else:
-            step = 1
-        
-        # "," used to denote lists of values
-        # unparsed_values is a list of strings, parsed_values is a list of integers generated from the strings
-        unparsed_values = interval_string.split(',')
-        parsed_values = []
+        valid_range = self._VALID_RANGES[interval_type]
+        valid_min = valid_range[0]
+        valid_max = valid_range[-1]
 
-        for u_val in unparsed_values:
-            # "-" used to denote ranges
-            if '-' in u_val:
-                if u_val.count('-') > 1:
-                    raise ValueError('Can only have one "-" in range')
-                
-                beginning, end = u_val.split('-')
-                if int(beginning) < valid_min:
-                    raise ValueError(f'{beginning} too low for the {interval_type} range')
-                if int(end) < int(beginning):
-                    raise ValueError(f'{end} is greater than {beginning} for the {interval_type} range')
+        # "," used to denote lists of values, each of which is matched once by _TOKEN_RE
+        # parsed_values is the bitmask generated from them
+        parsed_values = 0
 
-                # Silently correcting to avoid usually-valid date overruns like a 30 overflowing Feb 28
-                end = int(end) if int(end) in valid_range else valid_max
-                parsed_values.extend(range(int(beginning), int(end)+1, step))
+        for token in interval_string.split(','):
+            match = self._TOKEN_RE.fullmatch(token)
+            if not match:
+                raise ValueError(f'"{token}" is not a valid {interval_type} value')
+            whole, beginning, end, step_string = match.groups()
+
+            # "/" used to set step value, applying to the value it follows
+            step = int(step_string) if step_string else 1
+            if step < 1:
+                raise ValueError(f'Step in "{token}" must be at least 1')
 
             # "*" used to mean every valid value
-            elif u_val == '*':
-                parsed_values.extend(range(valid_min, valid_max+1, step))
+            if whole == '*':
+                first, last = valid_min, valid_max
+
+            # "-" used to denote ranges
+            elif end:
+                first, last = int(beginning), int(end)
+                if first < valid_min:
+                    raise ValueError(f'{beginning} too low for the {interval_type} range')
+                if first > valid_max:
+                    raise ValueError(f'{beginning} too high for the {interval_type} range')
+                if last < first:
+                    raise ValueError(f'{end} is less than {beginning} for the {interval_type} range')
+
+                # Silently correcting ranges that run past the end, like 50-70 for minutes
+                last = last if last in valid_range else valid_max
 
             else:
-                if int(u_val) not in valid_range:
-                    raise ValueError(f'{u_val} out of range for {interval_type}')
-                parsed_values.append(int(u_val))
-        
-        return sorted(set(parsed_values))
+                first = last = int(beginning)
+                if first not in valid_range:
+                    raise ValueError(f'{beginning} out of range for {interval_type}')
 
-    def should_backup(self) -> bool:
-        # Returns True if the source has had a backup interval elapse since the script was last run, else False.
-        current_date = LASTRUN.date()
-        end_date = START_TIME.date()
+                # As in cron, a single value with a step runs from that value to the end, so "5/10" is "5-max/10"
+                if step_string:
+                    last = valid_max
+
+            for value in range(first, last+1, step):
+                parsed_values |= 1 << value
+        
+        return parsed_values
+
+    def _matches_day(self, day: date) -> bool:
+        # Returns True if the month, day of month and day of week all match the cron constraints
+        # Cron counts weekdays from Sunday, Python from Monday
+        return bool((self._interval_dict['month'] >> day.month) & 1 and
+                    (self._interval_dict['day_of_month'] >> day.day) & 1 and
+                    (self._interval_dict['day_of_week'] >> (day.weekday() + 1) % 7) & 1)
+
+    def should_backup(self, now: datetime, lastrun: datetime) -> bool:
+        # Returns True if a backup interval has elapsed between lastrun and now, else False.
+
+        # When run every minute, now is the only scheduled time that can have been missed, so just check it
+        if now - lastrun <= timedelta(minutes=1):
+            return (lastrun < now and self._matches_day(now) and
+                    bool((self._minutes_of_day >> (now.hour*60 + now.minute)) & 1))
+
+        current_date = lastrun.date()
+        end_date = now.date()
+
+        # Pulled into locals once, rather than looked up on every day of a long catch-up
+        months = self._interval_dict['month']
+        days_of_month = self._interval_dict['day_of_month']
+        days_of_week = self._interval_dict['day_of_week']
+        minutes_of_day = self._minutes_of_day
+        one_day = timedelta(days=1)
+
+        # The jumps below need at least one value set in each field; a schedule without one can never match
+        if not (months and days_of_month and days_of_week and minutes_of_day):
+            return False
+
+        # lastrun and now as whole wall-clock minutes since day 1 of the proleptic calendar, so each day's window is plain int arithmetic
+        # Wall-clock rather than POSIX time, as cron schedules follow the clock through DST changes
+        lastrun_minute = lastrun.toordinal()*24*60 + lastrun.hour*60 + lastrun.minute
+        now_minute = now.toordinal()*24*60 + now.hour*60 + now.minute
 
         while current_date <= end_date:
-            # Only check days that match the cron constraints
-            candidate_day = datetime.combine(current_date, datetime.min.time())
-            
-            if (candidate_day.month in self._interval_dict['month'] and
-                candidate_day.day in self._interval_dict['day_of_month'] and
-                (candidate_day.weekday() in self._interval_dict['day_of_week'] or
-                 (7 in self._interval_dict['day_of_week'] and candidate_day.weekday() == 6))):
-
-                # Now check each valid hour/minute on this day
-                for hour in self._interval_dict['hour']:
-                    for minute in self._interval_dict['minute']:
-                        try:
-                            candidate = candidate_day.replace(hour=hour, minute=minute)
-                            if LASTRUN < candidate <= START_TIME:
-                                return True
-                        except ValueError:
-                            continue  # Skip invalid times like Feb 30
-            current_date += timedelta(days=1)
+            next_month = date(current_date.year + current_date.month // 12, current_date.month % 12 + 1, 1)
+
+            # Skip straight to the next scheduled month, wrapping round to the first one next year
+            # The lowest set bit of later_months is the number of months until then
+            if not (months >> current_date.month) & 1:
+                later_months = months >> current_date.month
+                if later_months:
+                    current_date = date(current_date.year, current_date.month + (later_months & -later_months).bit_length() - 1, 1)
+                else:
+                    current_date = date(current_date.year + 1, (months & -months).bit_length() - 1, 1)
+                continue
+
+            # Likewise skip straight to the next scheduled day of the month
+            # The lowest set bit of later_days is the number of days until then
+            later_days = days_of_month >> current_date.day
+            if not later_days & 1:
+                if later_days:
+                    current_date = min(current_date + timedelta(days=(later_days & -later_days).bit_length() - 1), next_month)
+                else:
+                    current_date = next_month
+                continue
+
+            # Month and day of month already match here, so only the day of week is left to check
+            # If it doesn't match, skip to the next scheduled weekday; the days in between can't match either
+            # Cron counts weekdays from Sunday, Python from Monday
+            weekday = (current_date.weekday() + 1) % 7
+            if not (days_of_week >> weekday) & 1:
+                later_weekdays = ((days_of_week >> weekday) | (days_of_week << (7 - weekday))) & 0x7f
+                current_date += timedelta(days=(later_weekdays & -later_weekdays).bit_length() - 1)
+                continue
+
+            day_start = current_date.toordinal()*24*60
+
+            # Minutes into this day that fall within (lastrun, now]
+            # Masking out that span of minutes_of_day checks every scheduled time in it at once
+            first = max(0, lastrun_minute - day_start + 1)
+            last = min(24*60 - 1, now_minute - day_start)
+            if first <= last and minutes_of_day & ((1 << (last + 1)) - (1 << first)):
+                return True
+            current_date += one_day
 
         return False
 
 
+def _make_interval(cron_string: str) -> Interval:
+    # Destinations often share a schedule, so each distinct cron string is only parsed once
+    # Keyed on the whitespace-normalised string, so "0 * * * *" and "0  * * * * " share one Interval
+    return _intern_interval(' '.join(cron_string.split()))
+
+
+@functools.lru_cache(maxsize=None)
+def _intern_interval(cron_string: str) -> Interval:
+    # Safe to share, as an Interval isn't modified after it's built
+    return Interval(cron_string)
+
+
 class Destination:
     # Represents a destination path to back up to and a means of getting there
     def __init__(self, source_path: Path, config: dict):
@@ -147,53 +394,298 @@ class Destination:
         self.config = config
         self.method = config['method']['type']
         self.path = config['path']
-        self.interval = Interval(config['interval'])
+        self.interval = _make_interval(config['interval'])
     
 
-    def backup(self):
-        if self.interval.should_backup():
-            self.method.backup(self.source_path, self.path)
+    @property
+    def snapshot_root(self) -> Path:
+        # Each source's snapshots go in their own directory, mirroring the source's path under the destination
+        # so sources sharing a destination never write into, or --delete from, each other's snapshots
+        source = Path(self.source_path).absolute()
+        return Path(self.path).absolute() / source.relative_to(source.anchor)
+
+
+    @property
+    def needs_walk(self) -> bool:
+        # rsync reads the source tree itself, so destinations it handles don't need the Source's walk
+        return not (self.method == 'rsync' or (self.method == 'cp' and RSYNC))
+
+
+    def _previous_snapshot(self, dest_root: Path, ctx: BackupContext) -> Path | None:
+        # Returns the most recent snapshot taken before this cycle at dest_root, or None if there isn't one
+        snapshots = []
+        try:
+            with os.scandir(dest_root) as entries:
+                for entry in entries:
+                    try:
+                        datetime.strptime(entry.name, SNAPSHOT_FORMAT)
+                    except ValueError:
+                        continue
+                    if entry.is_dir(follow_symlinks=False) and entry.name < ctx.snapshot_name:
+                        snapshots.append(entry.name)
+        except FileNotFoundError:
+            return None
+
+        return dest_root / max(snapshots) if snapshots else None
+
+
+    def _rsync(self, ctx: BackupContext) -> None:
+        # Copies the source into a new snapshot directory named after the cycle
+        # --link-dest hard-links files unchanged since the previous snapshot instead of copying them again, so each snapshot is complete but only changes take space
+        dest_root = self.snapshot_root
+        target = str(dest_root / ctx.snapshot_name)
+        previous = self._previous_snapshot(dest_root, ctx)
+
+        # A snapshot for this minute already exists when another cycle, like a manual run, started in the same minute
+        dest_root.mkdir(parents=True, exist_ok=True)
+        try:
+            os.mkdir(target)
+        except FileExistsError:
+            print(f'Snapshot {target} already exists, skipping')
+            return
+
+        command = ['rsync', '-aH', '--delete']
+        if previous:
+            command += ['--link-dest', str(previous)]
+        command += [f'{self.source_path}/', f'{target}/']
+
+        result = subprocess.run(command)
+        if result.returncode in RSYNC_PARTIAL_CODES:
+            print(f'Warning: {RSYNC_PARTIAL_CODES[result.returncode]} while backing up {self.source_path} to {target}')
+        elif result.returncode:
+            # Otherwise a failed snapshot would be left looking like a complete one, and be linked against next time
+            _remove_snapshot(target)
+            raise subprocess.CalledProcessError(result.returncode, command)
+
+
+    def _copy(self, ctx: BackupContext, files: list[WalkEntry], dirs: list[WalkEntry], hardlinks: dict[tuple[int, int], list[str]]) -> None:
+        # Copies the source into a new snapshot directory named after the cycle, for cp destinations when rsync isn't installed
+        # Works from the Source's walk, so the source tree isn't statted again
+        # Like rsync --link-dest, a file with the same size, mtime, mode and owner as in the previous snapshot is hard-linked to it instead of copied
+        # Owners are kept like rsync -a when running as root; anyone else can only create files they own
+        dest_root = self.snapshot_root
+        target = str(dest_root / ctx.snapshot_name)
+        previous = self._previous_snapshot(dest_root, ctx)
+        prefix_len = len(os.path.join(self.source_path, ''))
+        keep_owner = os.geteuid() == 0
+
+        # A snapshot for this minute already exists when another cycle, like a manual run, started in the same minute
+        os.makedirs(dest_root, exist_ok=True)
+        try:
+            os.mkdir(target)
+        except FileExistsError:
+            print(f'Snapshot {target} already exists, skipping')
+            return
+
+        try:
+            # Directories are sorted by depth, so parents are always created first
+            # Created writable and given their real modes at the end, so read-only directories can still be filled
+            for path, _, _, _, _, _, _, _ in dirs:
+                os.mkdir(os.path.join(target, path[prefix_len:]), 0o700)
+
+            # First copy of each group of hard links in the source, so the others can be linked to it
+            linked: dict[tuple[int, int], str] = {}
+
+            for path, mtime_ns, size, dev, ino, mode, uid, gid in files:
+                rel_path = path[prefix_len:]
+                dst = os.path.join(target, rel_path)
+
+                try:
+                    if (dev, ino) in linked:
+                        os.link(linked[(dev, ino)], dst)
+                        continue
+
+                    if stat.S_ISLNK(mode):
+                        # Symlinks are recreated as they are, like rsync -a, rather than followed
+                        os.symlink(os.readlink(path), dst)
+                        if keep_owner:
+                            os.lchown(dst, uid, gid)
+                        os.utime(dst, ns=(mtime_ns, mtime_ns), follow_symlinks=False)
+                        continue
+
+                    prev_file = os.path.join(previous, rel_path) if previous else None
+                    try:
+                        st = os.stat(prev_file, follow_symlinks=False) if prev_file else None
+                    except FileNotFoundError:
+                        st = None
+
+                    if (st and st.st_size == size and st.st_mtime_ns == mtime_ns and st.st_mode == mode
+                            and (not keep_owner or (st.st_uid, st.st_gid) == (uid, gid))):
+                        os.link(prev_file, dst)
+                    else:
+                        _copy_file(path, dst)
+                        # chown first, as it clears setuid and setgid bits
+                        if keep_owner:
+                            os.chown(dst, uid, gid)
+                        os.chmod(dst, mode & 0o7777)
+                        os.utime(dst, ns=(mtime_ns, mtime_ns))
+                except (FileNotFoundError, PermissionError) as e:
+                    # Like the walk, carry on past source files that vanished since or can't be read, instead of abandoning the snapshot
+                    if e.filename != path:
+                        raise
+                    print(f'Skipping {path}: {e.strerror}')
+                    continue
+
+                if (dev, ino) in hardlinks:
+                    linked[(dev, ino)] = dst
+
+            # Directory owners, modes and mtimes go last, since filling a directory changes its mtime and may need write access
+            # Deepest first for the same reason
+            for path, mtime_ns, _, _, _, mode, uid, gid in reversed(dirs):
+                dst = os.path.join(target, path[prefix_len:])
+                if keep_owner:
+                    os.chown(dst, uid, gid)
+                os.chmod(dst, mode & 0o7777)
+                os.utime(dst, ns=(mtime_ns, mtime_ns))
+        except BaseException:
+            # Otherwise a failed snapshot would be left looking like a complete one, and be linked against next time
+            _remove_snapshot(target)
+            raise
+
+
+    def backup(self, ctx: BackupContext, files: list[WalkEntry], dirs: list[WalkEntry], hardlinks: dict[tuple[int, int], list[str]]):
+        # Takes the Source's walk results, shared by all of its destinations; they're read-only here
+        # Nothing needs to be walked or statted again per destination
+        # Whether the interval has elapsed is checked by the Source, before it walks the tree
+        # Only methods in BACKUP_METHODS get this far: cp copies from the walk when rsync isn't installed, everything else goes through rsync
+        if self.needs_walk:
+            self._copy(ctx, files, dirs, hardlinks)
+        else:
+            self._rsync(ctx)
 
 
 class Source:
     # Represents a directory on the local system and all contents and subdirectories
     def __init__(self, path: Path, destinations: list[dict[dict]]):
         self.path = path
-        self.dirs = []
-        self.files = []
 
-        self.destinations: list[Destination] = [Destination(self.path, x) for x in destinations]
+        # Metadata gathered by _walk; the single view of the tree shared by all destinations
+        self.dirs: list[WalkEntry] = []
+        self.files: list[WalkEntry] = []
+        self.hardlinks: dict[tuple[int, int], list[str]] = {}
+
+        # Destinations that can't be backed up to yet are left out with a warning, rather than failing every cycle
+        self.destinations: list[Destination] = []
+        for config in destinations:
+            method = config['method']['type']
+            if method not in BACKUP_METHODS:
+                print(f'Skipping destination {config['path']}: backup method {method} is not implemented yet')
+            elif REMOTE_PATH_RE.match(config['path']):
+                print(f'Skipping destination {config['path']}: remote destinations are not supported yet')
+            else:
+                self.destinations.append(Destination(self.path, config))
+
+        # For partial backups: destinations by path, and paths already reported as missing so each is only reported once
+        self._destinations_by_path: dict[Path, Destination] = {Path(d.path): d for d in self.destinations}
+        self._missing: set[Path] = set()
+
+
+    def _scan(self, root: str) -> None:
+        # Single pass over the tree, sorting entries into self.dirs and self.files as they're found. Symlinks go in self.files, unfollowed
+        # DirEntry answers is_dir/is_file from the directory listing, so each entry costs a single stat
+        # Directories still to be listed are queued rather than recursed into, so deep trees can't hit the recursion limit
+        # and only one directory is held open at a time
+        # The queue is first in, first out, so the tree is read a level at a time and both lists come out ordered by depth
+        queue = deque([root])
+        while queue:
+            path = queue.popleft()
+            try:
+                entries = os.scandir(path)
+            except OSError as e:
+                # The root itself failing would otherwise leave an empty snapshot that counts as a successful backup
+                if path == root:
+                    raise
+                # Like os.walk, carry on past directories that can't be listed instead of abandoning the whole backup
+                print(f'Skipping {path}: {e.strerror}')
+                continue
+
+            with entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            self.dirs.append((entry.path, *_stat_entry(entry)))
+                            queue.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False) or entry.is_symlink():
+                            self.files.append((entry.path, *_stat_entry(entry)))
+                    except FileNotFoundError:
+                        # Deleted since the directory was listed, which is routine for temporary files
+                        continue
 
 
     def _walk(self) -> None:
-        # Create a list of file, timestamp tuples of the directories and files
-        # Sort it by path length to ensure the directories and files aren't created out of order later
-        dirs = sorted([p for p in self.path.rglob('*') if p.is_dir()], key=lambda p: len(p.parts))
-        self.dirs: list[tuple[Path, datetime]] = [(p, datetime.fromtimestamp(p.stat().st_mtime)) for p in dirs]
-
-        files = sorted([p for p in self.path.rglob('*') if p.is_file()], key=lambda p: len(p.parts))
-        self.files: list[tuple[Path, datetime]] = [(p, datetime.fromtimestamp(p[0].stat().st_mtime)) for p in files]
+        # Create a list of path, mtime, size, device, inode, mode, uid, gid tuples of the directories, and of the files and symlinks
+        # mtimes are kept as the raw nanosecond ints; building a datetime per entry is expensive and nothing needs one
+        # Paths are kept as plain strings; wrap them in Path only where needed
+        # _scan reads the tree breadth-first, so parents always come before their contents and nothing is created out of order later
+        self.dirs = []
+        self.files = []
+        self._scan(str(self.path))
+
+        # Group the paths of files sharing a device and inode, so they can be linked at the destination rather than copied twice
+        by_inode: dict[tuple[int, int], list[str]] = defaultdict(list)
+        for path, _, _, dev, ino, mode, _, _ in self.files:
+            if not stat.S_ISLNK(mode):
+                by_inode[(dev, ino)].append(path)
+
+        self.hardlinks = {inode: paths for inode, paths in by_inode.items() if len(paths) > 1}
+
+
+    def backup(self, ctx: BackupContext, destinations: list[Path] | None = None):
+        # Backs up to every destination due, or only those of the given destination paths that are due
+        if destinations:
+            candidates = []
+            for dest_path in map(Path, destinations):
+                destination = self._destinations_by_path.get(dest_path)
+                if destination:
+                    candidates.append(destination)
+                elif dest_path not in self._missing:
+                    self._missing.add(dest_path)
+                    print(f'Destination {dest_path} not found in source {self.path}')
+        else:
+            candidates = self.destinations
 
+        # Check the intervals before walking, so runs where nothing is due don't traverse the tree at all
+        needed = [d for d in candidates if d.interval.should_backup(ctx.now, ctx.lastruns.get(str(self.path), d.path))]
+        if not needed:
+            return
 
-    def backup(self, destinations=None):
         # First, get an idea for what's in the directory and needs to be backed up
-        self._walk()
+        # Skipped when every destination due reads the tree itself
+        if any(d.needs_walk for d in needed):
+            self._walk()
 
-        # The check is to allow partial backups to be implemented later
-        if not destinations:
-            for destination in self.destinations:
-                destination.backup()
-        else:
-            for destination in destinations:
-                if destination in vars(self.destinations):
-                    dest_obj = [x for x in self.destinations if x.dest_path == destination]
-                    backup_method = getattr(dest_obj, 'backup', None)
-                    backup_method()
-                else:
-                    print(f'Destination {destination} not found in source {self.path}')
-                    continue
+        # Destinations are independent and mostly wait on disks or the network, so they run concurrently
+        # list() waits for them all and re-raises the first failure
+        with ThreadPoolExecutor(max_workers=len(needed)) as executor:
+            list(executor.map(lambda d: self._backup_to(ctx, d), needed))
+
+
+    def _backup_to(self, ctx: BackupContext, destination: Destination) -> None:
+        # Only recorded once the destination succeeds, so a failed backup is retried next cycle
+        destination.backup(ctx, self.files, self.dirs, self.hardlinks)
+        ctx.lastruns.record(str(self.path), destination.path, ctx.now)
                 
 
+# Parsed YAML files, with the mtime each was parsed at
+_yaml_cache: dict[Path, tuple[int, dict]] = {}
+
+
+def load_yaml(path: Path) -> dict:
+    # Returns the parsed YAML file at path
+    # Kept in memory and reused while the file's mtime is unchanged, so a long-running process doesn't re-read and re-parse it every cycle
+    # The result is shared between callers, so it must not be modified
+    mtime_ns = path.stat().st_mtime_ns
+    cached = _yaml_cache.get(path)
+    if cached and cached[0] == mtime_ns:
+        return cached[1]
+
+    with open(path, 'r') as f:
+        parsed = yaml.load(f, Loader=YAML_LOADER)
+
+    _yaml_cache[path] = (mtime_ns, parsed)
+    return parsed
+
+
 def check_backup_permissions(target_user: str, targets: list[Path]) -> bool:
     # Takes a user to back up as, and the directory back up
     # Throws a PermissionError if not authorized, returns True if authorized to make script logic flow more naturally
@@ -204,8 +696,7 @@ def check_backup_permissions(target_user: str, targets: list[Path]) -> bool:
     if current_uid == 0:
         return True
 
-    with open(CONFIG_FILE, 'r') as f:
-        global_config = yaml.safe_load(f)
+    global_config = load_yaml(CONFIG_FILE)
 
     # First check user permissions
     # non-root isn't allowed to use --user for anyone but themselves
@@ -226,9 +717,12 @@ def check_backup_permissions(target_user: str, targets: list[Path]) -> bool:
     if Path('/').resolve() in allowed_dirs:
         return True
 
+    # Plain string prefix checks; the trailing "/" keeps "/home/user1" from also allowing "/home/user10"
+    allowed_prefixes = tuple(os.path.join(p, '') for p in allowed_dirs)
+
     for target in targets:
         target_path = target.resolve()
-        if not any(target_path.is_relative_to(p) for p in allowed_dirs):
+        if not os.path.join(target_path, '').startswith(allowed_prefixes):
             raise PermissionError(f'{target_path} is not inside an allowed backup directory. Ask an admin for assistance')
 
     return True
@@ -250,7 +744,10 @@ def is_existing_dir(path_str: str) -> list[Path]:
 
 
 def is_valid_user(username: str) -> str:
-    if not username in [x.pw_name for x in pwd.getpwall()]:
+    # A single lookup by name rather than listing every account, which can be slow with NSS backends like LDAP
+    try:
+        pwd.getpwnam(username)
+    except KeyError:
         raise argparse.ArgumentTypeError(f'{username} not an existing user')
     return username
 
@@ -318,7 +815,7 @@ def install():
     SCRIPT_LOCATION.chmod(mode=0o755)
 
     with open(LASTRUN_FILE, 'w') as f:
-        f.write('0')
+        f.write('{}')
 
     with open(SERVICE_PATH, 'w') as f:
         f.write(f'''\n[Unit]\nDescription=Pybackup\nAfter=multi-user.target\n\n[Service]\nExecStart="{SCRIPT_LOCATION} backup"\nRestart=on-failure\nRestartSec=30\n\n[Install]\nWantedBy=multi-user.target''')
@@ -342,8 +839,18 @@ def uninstall():
 
     remove = input('Delete backups? [y/N] ')
     if remove.lower().strip() == 'y':
-        
-        shutil.rmtree(BACKUP_LOCATION)
+        # Bottom-up, so every directory is already empty by the time it's removed
+        # Symlinks to directories show up in dirs but are never descended into, and are unlinked rather than removed
+        for root, dirs, files in os.walk(BACKUP_LOCATION, topdown=False):
+            for name in files:
+                os.unlink(os.path.join(root, name))
+            for name in dirs:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    os.unlink(path)
+                else:
+                    os.rmdir(path)
+        BACKUP_LOCATION.rmdir()
 
     CONFIG_LOCATION.rmdir()
 
@@ -351,34 +858,50 @@ def uninstall():
 
 
 def backup(args):
-    if not check_backup_permissions(args.backup.user, args.backup.target):
-        raise PermissionError('Action not authorized')
-
-    effective_uid = pwd.getpwnam(args.backup.user).pw_uid
+    effective_uid = pwd.getpwnam(args.user).pw_uid
     home_dir = Path(pwd.getpwuid(effective_uid).pw_dir)
 
-    with open(home_dir / 'backupconfig.yaml') as f:
-        backup_config = yaml.safe_load(f)
+    backup_config = load_yaml(home_dir / 'backupconfig.yaml')
 
     # If a backup target isn't explicitly given, backup everything allowed
     targets: list[dict]
-    if not args.backup.target:
+    if not args.target:
         sources: list[dict] = backup_config['source']
 
         for source in sources:
-            if not source['path'].exists():
-                raise FileExistsError(f'Backup source {source['path']} does not exist')
+            if not Path(source['path']).exists():
+                raise FileNotFoundError(f'Backup source {source['path']} does not exist')
+
+        targets = sources
 
     # Otherwise, check the config to see which method, destination, and other details are applicable
     # Normalize to a list of dictionaries to match the other possibility
     # The existence check is done in argparse, so no need to match
     else:
+        # argparse gives the target as a one-item list
+        target = args.target[0]
+        targets = []
         for source in backup_config['source']:
-            if Path(args.backup.target).is_relative_to(Path(source['path'])):
-                targets = [source]
-                targets[0]['path'] = args.backup.target
+            if target.is_relative_to(Path(source['path'])):
+                # Copied, since the parsed config is cached and shared
+                targets = [dict(source, path=target)]
                 break
 
+        if not targets:
+            raise ValueError(f'{target} is not inside any backup source in {home_dir / "backupconfig.yaml"}')
+
+    # Checked once the targets are known, so full runs have every configured source checked against the allowed directories too
+    if not check_backup_permissions(args.user, [Path(target['path']) for target in targets]):
+        raise PermissionError('Action not authorized')
+
+    ctx = BackupContext.start()
+
+    # Sources are independent as well, so they're backed up concurrently too
+    sources = [Source(Path(target['path']), target['destinations']) for target in targets]
+    if sources:
+        with ThreadPoolExecutor(max_workers=min(32, len(sources))) as executor:
+            list(executor.map(lambda s: s.backup(ctx), sources))
+
 
 
 
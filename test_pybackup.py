@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import random
+import unittest
+from datetime import datetime, timedelta
+
+from pybackup import Interval
+
+
+FIELD_BOUNDS: list[tuple[int, int]] = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+
+def expand_field(field: str, low: int, high: int) -> set[int]:
+    # Independent, deliberately plain reading of one cron field, to check Interval's bitmasks against
+    values = set()
+    for token in field.split(','):
+        base, _, step = token.partition('/')
+        step = int(step) if step else 1
+        if base == '*':
+            first, last = low, high
+        elif '-' in base:
+            first, last = map(int, base.split('-'))
+            last = min(last, high)
+        else:
+            first = int(base)
+            last = high if '/' in token else first
+        values |= set(range(first, last + 1, step))
+    return values
+
+
+def brute_force(cron_string: str, now: datetime, lastrun: datetime) -> bool:
+    # Steps through every minute in (lastrun, now] and checks it against the expanded fields
+    minutes, hours, days, months, weekdays = (expand_field(field, *bounds) for field, bounds in zip(cron_string.split(), FIELD_BOUNDS))
+    if 7 in weekdays:
+        weekdays.add(0)
+
+    minute = lastrun.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    while minute <= now:
+        if (minute.minute in minutes and minute.hour in hours and minute.day in days and minute.month in months
+                and minute.isoweekday() % 7 in weekdays):
+            return True
+        minute += timedelta(minutes=1)
+    return False
+
+
+def random_field(low: int, high: int) -> str:
+    choice = random.random()
+    if choice < 0.3:
+        return '*'
+    if choice < 0.45:
+        return f'*/{random.randint(1, 7)}'
+    if choice < 0.55:
+        return f'{random.randint(low, high)}/{random.randint(2, 9)}'
+    if choice < 0.8:
+        return ','.join(str(random.randint(low, high)) for _ in range(random.randint(1, 3)))
+    first = random.randint(low, high)
+    last = random.randint(first, high)
+    return f'{first}-{last}' + (f'/{random.randint(1, 3)}' if random.random() < 0.3 else '')
+
+
+class TestShouldBackup(unittest.TestCase):
+    def check(self, cron_string: str, now: datetime, lastrun: datetime, expected: bool):
+        with self.subTest(cron=cron_string, now=now, lastrun=lastrun):
+            self.assertEqual(Interval(cron_string).should_backup(now, lastrun), expected)
+
+
+    def test_matches_brute_force(self):
+        random.seed(0)
+        for _ in range(300):
+            cron_string = ' '.join(random_field(*bounds) for bounds in FIELD_BOUNDS)
+            now = datetime(2024, random.randint(1, 12), random.randint(1, 28), random.randint(0, 23), random.randint(0, 59))
+            window = random.choice([0, 1, 2, 59, 61, 1439, 1440, 1441, 4000, random.randint(0, 12000)])
+            lastrun = now - timedelta(minutes=window, seconds=random.choice([0, 0, 17]))
+            self.check(cron_string, now, lastrun, brute_force(cron_string, now, lastrun))
+
+
+    def test_single_value_with_step(self):
+        self.assertEqual(expand_field('5/10', 0, 59), {5, 15, 25, 35, 45, 55})
+        self.check('5/10 * * * *', datetime(2024, 1, 1, 10, 35), datetime(2024, 1, 1, 10, 34), True)
+        self.check('5/10 * * * *', datetime(2024, 1, 1, 10, 36), datetime(2024, 1, 1, 10, 35), False)
+
+
+    def test_day_missing_from_month_never_matches(self):
+        self.check('0 0 31 2 *', datetime(2025, 1, 1), datetime(2024, 1, 1), False)
+        self.check('0 0 29 2 *', datetime(2025, 1, 1), datetime(2024, 1, 1), True)
+
+
+    def test_sunday_as_7(self):
+        # 2024-01-07 was a Sunday
+        sunday_noon = datetime(2024, 1, 7, 12, 0)
+        for weekday in ('0', '7'):
+            self.check(f'0 12 * * {weekday}', sunday_noon, sunday_noon - timedelta(minutes=1), True)
+            self.check(f'0 12 * * {weekday}', sunday_noon, sunday_noon - timedelta(days=6), True)
+            self.check(f'0 12 * * {weekday}', sunday_noon - timedelta(days=1), sunday_noon - timedelta(days=7), False)
+
+
+    def test_empty_window(self):
+        now = datetime(2024, 1, 1, 10, 0)
+        self.check('* * * * *', now, now, False)
+        self.check('* * * * *', now, now + timedelta(minutes=5), False)
+
+
+    def test_one_minute_window(self):
+        # lastrun itself is excluded and now is included
+        lastrun = datetime(2024, 1, 1, 10, 0)
+        self.check('1 10 * * *', lastrun + timedelta(minutes=1), lastrun, True)
+        self.check('0 10 * * *', lastrun + timedelta(minutes=1), lastrun, False)
+        self.check('1 10 * * *', lastrun + timedelta(minutes=1), lastrun + timedelta(seconds=30), True)
+
+
+    def test_wraps_into_next_year(self):
+        self.check('0 0 1 1 *', datetime(2026, 1, 1, 0, 0), datetime(2025, 12, 1), True)
+        self.check('0 0 1 1 *', datetime(2025, 12, 31, 23, 59), datetime(2025, 1, 2), False)
+
+
+class TestParse(unittest.TestCase):
+    def test_rejects_out_of_range(self):
+        for cron_string in ('* * * 13-15 *', '* * * * 8-9', '* * 32-40 * *', '60 * * * *', '* 24 * * *', '* * 0 * *'):
+            with self.subTest(cron=cron_string), self.assertRaises(ValueError):
+                Interval(cron_string)
+
+
+    def test_rejects_malformed(self):
+        for cron_string in ('* * * *', '* * * * * *', '*/0 * * * *', '5-2 * * * *', 'a * * * *', '1,,2 * * * *'):
+            with self.subTest(cron=cron_string), self.assertRaises(ValueError):
+                Interval(cron_string)
+
+
+if __name__ == '__main__':
+    unittest.main()